@@ -1,50 +1,125 @@
 from fastapi import FastAPI, Depends, HTTPException, status, BackgroundTasks, Query
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
 from pydantic import BaseModel, EmailStr, Field
 from passlib.context import CryptContext
-from datetime import datetime, timedelta
+from datetime import timedelta
 from typing import List, Union, Optional
 from bson import ObjectId
-from jose import JWTError, jwt
+from bson.errors import InvalidId
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
+import heapq
+import jwt
+import logging
 import os
+import time
 
 load_dotenv()
-# Initialize FastAPI
-app = FastAPI()
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+# passlib 1.7.4 can't read the version of bcrypt>=4.1 and logs a harmless traceback on first use
+logging.getLogger("passlib.handlers.bcrypt").setLevel(logging.ERROR)
 
 # MongoDB Connection Configuration
 
 SECRET_KEY = os.environ["SECRET_KEY"]
 ALGORITHM = os.environ["ALGORITHM"]
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.environ["ACCESS_TOKEN_EXPIRE_MINUTES"])
+ACCESS_TOKEN_EXPIRE = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+if not SECRET_KEY or not ALGORITHM:
+    raise RuntimeError("SECRET_KEY and ALGORITHM must be set")
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", "10"))
+CORS_ORIGINS = [origin.strip() for origin in os.environ.get("CORS_ORIGINS", "*").split(",") if origin.strip()]
 
 MONGO_DETAILS = os.environ["MONGO_DETAILS"]
 DATABEASE = os.environ["DATABEASE"]
 
-client = AsyncIOMotorClient(MONGO_DETAILS)
+client = AsyncIOMotorClient(
+    MONGO_DETAILS,
+    minPoolSize=10,
+    maxPoolSize=50,
+    compressors="zstd,zlib",
+    serverSelectionTimeoutMS=2000,
+    uuidRepresentation="standard",
+)
 db = client[DATABEASE]
 
 # Define collections for users and games
 users_collection = db["user"]
 games_collection = db["game"]
 
+# Indexes backing the sort options of list_games, keyed by sort_by
+GAME_SORT_INDEXES = {
+    "name": [("name", 1), ("_id", 1)],
+    "price": [("price.base", 1), ("_id", 1)],
+    "ratings": [("ratings.percentage", -1), ("_id", 1)],
+}
+
+# (sort_by, sort_order) -> sort spec for list_games; _id breaks ties in index order
+GAME_SORT_TABLE = {
+    ("price", "asc"): [("price.base", 1), ("_id", 1)],
+    ("price", "desc"): [("price.base", -1), ("_id", -1)],
+    ("name", "asc"): [("name", 1), ("_id", 1)],
+    ("name", "desc"): [("name", -1), ("_id", -1)],
+    ("ratings", "asc"): [("ratings.percentage", -1), ("_id", 1)],
+    ("ratings", "desc"): [("ratings.percentage", 1), ("_id", -1)],
+}
+DEFAULT_GAME_SORT = [("_id", 1)]
+
+# Password Hashing Context
+pwd_context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=BCRYPT_ROUNDS, deprecated="auto")
+
+# Verified against when the user does not exist, so every login costs one bcrypt check
+DUMMY_HASH = pwd_context.hash("dummy_for_timing")
+
+# OAuth2 for Authentication
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+
+# Decode options shared by every token check; missing claims are rejected by PyJWT
+JWT_DECODE_OPTIONS = {"verify_aud": False, "require": ["sub", "exp"]}
+
+# Cache of validated tokens: raw token -> (user, exp timestamp)
+TOKEN_CACHE_MAXSIZE = 10_000
+token_cache = {}
+# Min-heap of (exp, token) so expired or soonest-expiring entries are found cheaply
+token_expiry_heap = []
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Make sure passlib dispatches to the native bcrypt package, not a slow fallback
+    backend = pwd_context.handler("bcrypt").get_backend()
+    if backend != "bcrypt":
+        raise RuntimeError(f"passlib is using the '{backend}' bcrypt backend; install bcrypt>=4.1")
+    logger.info("passlib bcrypt backend: %s", backend)
+
+    # Open the connection pool now rather than on the first user request
+    await client.admin.command("ping")
+
+    for keys in GAME_SORT_INDEXES.values():
+        await games_collection.create_index(keys)
+
+    yield
+
+
+# Initialize FastAPI
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
 # CORS Middleware (Optional)
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=CORS_ORIGINS,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    max_age=86400,  # Let browsers cache preflight responses for a day
 )
 
-# Password Hashing Context
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
-# OAuth2 for Authentication
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 # Helper class to validate ObjectId (MongoDB _id)
 class PyObjectId(ObjectId):
@@ -54,9 +129,13 @@ class PyObjectId(ObjectId):
 
     @classmethod
     def validate(cls, v, x):
-        if not ObjectId.is_valid(v):
+        # ObjectId(None) generates a fresh id instead of failing
+        if v is None:
+            raise ValueError("Invalid ObjectId")
+        try:
+            return ObjectId(v)
+        except (InvalidId, TypeError):
             raise ValueError("Invalid ObjectId")
-        return ObjectId(v)
     
     @classmethod
     def __get_pydantic_core_schema__(cls, _source_type, handler):
@@ -105,6 +184,11 @@ class Game(BaseModel):
     gradingProvider: Optional[str] = None
 
 
+# Only fetch the fields a Game exposes (_id is always returned)
+GAME_FIELDS = tuple(Game.model_fields)
+GAME_PROJECTION = {field: 1 for field in GAME_FIELDS}
+
+
 class UpdateGameModel(BaseModel):
     id: PyObjectId = Field(...)
     game_id: Union[str, None] = None
@@ -153,30 +237,26 @@ class UpdateGameModel(BaseModel):
             }
         }
 
-class TokenData(BaseModel):
-    username: Optional[str] = None
-
-
 class Token(BaseModel):
     access_token: str
     token_type: str
 
 
 # Helper Functions for Passwords
-def get_password_hash(password):
-    return pwd_context.hash(password)
+# Hashing is CPU bound, so run it in the threadpool to keep the event loop free
+async def get_password_hash(password):
+    return await run_in_threadpool(pwd_context.hash, password)
 
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password, hashed_password):
+    return await run_in_threadpool(pwd_context.verify, plain_password, hashed_password)
 
 
 # User Authentication and Database Interactions
 async def authenticate_user(username: str, password: str):
     user = await users_collection.find_one({"username": username})
-    if not user:
-        return False
-    if not verify_password(password, user["hashed_password"]):
+    hashed_password = user["hashed_password"] if user else DUMMY_HASH
+    if not await verify_password(password, hashed_password) or not user:
         return False
     return UserInDB(**user)
 
@@ -189,32 +269,60 @@ async def get_user(username: str):
 
 def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.utcnow() + expires_delta
-    else:
-        expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
+    expires_seconds = expires_delta.total_seconds() if expires_delta else 15 * 60
+    to_encode["exp"] = int(time.time() + expires_seconds)
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 
+def get_cached_user(token: str):
+    cached = token_cache.get(token)
+    if cached is None:
+        return None
+    user, expire = cached
+    if expire <= time.time():
+        token_cache.pop(token, None)
+        return None
+    return user
+
+
+def pop_token_expiry():
+    # Remove the heap head and its cache entry, unless the entry was replaced or already dropped
+    expire, token = heapq.heappop(token_expiry_heap)
+    cached = token_cache.get(token)
+    if cached is not None and cached[1] == expire:
+        del token_cache[token]
+
+
+def cache_user(token: str, user: User, expire: float):
+    now = time.time()
+    while token_expiry_heap and token_expiry_heap[0][0] <= now:
+        pop_token_expiry()
+    while len(token_cache) >= TOKEN_CACHE_MAXSIZE and token_expiry_heap:
+        # Still full of live tokens: evict the one closest to expiring
+        pop_token_expiry()
+    token_cache[token] = (user, expire)
+    heapq.heappush(token_expiry_heap, (expire, token))
+
+
 async def get_current_user(token: str = Depends(oauth2_scheme)):
+    user = get_cached_user(token)
+    if user is not None:
+        return user
+
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-        token_data = TokenData(username=username)
-    except JWTError:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM], options=JWT_DECODE_OPTIONS)
+    except jwt.PyJWTError:
         raise credentials_exception
 
-    user = await get_user(username=token_data.username)
+    user = await get_user(username=payload["sub"])
     if user is None:
         raise credentials_exception
+    cache_user(token, user, float(payload["exp"]))
     return user
 
 
@@ -234,8 +342,7 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(data={"sub": user.username}, expires_delta=access_token_expires)
+    access_token = create_access_token(data={"sub": user.username}, expires_delta=ACCESS_TOKEN_EXPIRE)
 
     return {"access_token": access_token, "token_type": "bearer"}
 
@@ -246,48 +353,58 @@ async def read_users_me(current_user: User = Depends(get_current_active_user)):
 
 
 # Game Routes
+def parse_game_id(game_id: str) -> ObjectId:
+    try:
+        return ObjectId(game_id)
+    except (InvalidId, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid game ID")
+
+
 @app.post("/games/", response_model=Game, status_code=201)
 async def create_game(game: Game, current_user: User = Depends(get_current_active_user)):
-    game_dict = game.dict()
+    game_dict = game.model_dump()
     game_dict["_id"] = PyObjectId()
-    new_game = await games_collection.insert_one(game_dict)
-    created_game = await games_collection.find_one({"_id": new_game.inserted_id})
-    return created_game
+    await games_collection.insert_one(game_dict)
+    return game_dict
 
 
-@app.get("/games/", response_model=List[Game])
+# Documents come straight from our own collection, so skip response validation
+@app.get("/games/", response_model=None, responses={200: {"model": List[Game]}})
 async def list_games(
-    limit: Optional[int] = Query(None, description="Limit the number of games returned"),
+    limit: Optional[int] = Query(None, ge=1, description="Limit the number of games returned"),
     sort_by: Optional[str] = Query(None, description="Sort by 'price', 'name', or 'ratings'"),
     sort_order: Optional[str] = Query("asc", description="Sort order: 'asc' for ascending or 'desc' for descending"),
     current_user: User = Depends(get_current_active_user)
 ):
-    sort_dict = []
-    if sort_by == "price":
-        sort_dict = [("price.base", 1 if sort_order == "asc" else -1)]
-    elif sort_by == "name":
-        sort_dict = [("name", 1 if sort_order == "asc" else -1)]
-    elif sort_by == "ratings":
-        sort_dict = [("ratings.percentage", -1 if sort_order == "asc" else 1)]
-    
-    # Use default sorting if no sort_by parameter is provided
-    if not sort_dict:
-        sort_dict = [("_id", 1)]
-
-    games = []
-    async for game in games_collection.find().sort(sort_dict).limit(limit or 0):
+    sort_dict = GAME_SORT_TABLE.get((sort_by, sort_order))
+
+    # Use default sorting if no valid sort_by/sort_order pair is provided
+    indexed = sort_dict is not None
+    if not indexed:
+        sort_dict = DEFAULT_GAME_SORT
+
+    cursor = games_collection.find({}, GAME_PROJECTION).sort(sort_dict).limit(limit or 0)
+    if limit:
+        cursor = cursor.batch_size(limit)
+    if indexed:
+        # Force the index sort and fail loudly instead of sorting in memory
+        cursor = cursor.hint(GAME_SORT_INDEXES[sort_by]).allow_disk_use(False)
+
+    games = await cursor.to_list(length=limit or None)
+    for game in games:
         game["game_id"] = game["id"]
-        game["id"] = str(game["_id"])  # Convert ObjectId to string if necessary
-        games.append(Game(**game))
-    
-    return games
+        game["id"] = str(game.pop("_id"))  # Convert ObjectId to string for serialization
+        for field in GAME_FIELDS:
+            game.setdefault(field, None)  # Keep the Game shape: missing fields come back as null
+
+    # Return the response directly so FastAPI skips jsonable_encoder as well
+    return ORJSONResponse(games)
 
 
 @app.get("/games/{game_id}", response_model=Game)
 async def get_game(game_id: str, current_user: User = Depends(get_current_active_user)):
-    if not ObjectId.is_valid(game_id):
-        raise HTTPException(status_code=400, detail="Invalid game ID")
-    game = await games_collection.find_one({"_id": ObjectId(game_id)})
+    oid = parse_game_id(game_id)
+    game = await games_collection.find_one({"_id": oid})
     if game is None:
         raise HTTPException(status_code=404, detail="Game not found")
     game["game_id"] = game["id"] 
@@ -298,12 +415,17 @@ async def get_game(game_id: str, current_user: User = Depends(get_current_active
 
 @app.put("/games/{game_id}", response_model=Game)
 async def update_game(game_id: str, game: UpdateGameModel, current_user: User = Depends(get_current_active_user)):
-    if not ObjectId.is_valid(game_id):
-        raise HTTPException(status_code=400, detail="Invalid game ID")
-    update_data = {k: v for k, v in game.dict().items() if v is not None}
+    oid = parse_game_id(game_id)
+    # Only non-null fields sent by the client are written
+    update_data = game.model_dump(exclude_unset=True, exclude_none=True)
     if update_data:
-        await games_collection.update_one({"_id": ObjectId(game_id)}, {"$set": update_data})
-    updated_game = await games_collection.find_one({"_id": ObjectId(game_id)})
+        updated_game = await games_collection.find_one_and_update(
+            {"_id": oid},
+            {"$set": update_data},
+            return_document=ReturnDocument.AFTER,
+        )
+    else:
+        updated_game = await games_collection.find_one({"_id": oid})
     if updated_game is None:
         raise HTTPException(status_code=404, detail="Game not found")
     return updated_game
@@ -311,9 +433,8 @@ async def update_game(game_id: str, game: UpdateGameModel, current_user: User =
 
 @app.delete("/games/{game_id}")
 async def delete_game(game_id: str, current_user: User = Depends(get_current_active_user)):
-    if not ObjectId.is_valid(game_id):
-        raise HTTPException(status_code=400, detail="Invalid game ID")
-    result = await games_collection.delete_one({"_id": ObjectId(game_id)})
+    oid = parse_game_id(game_id)
+    result = await games_collection.delete_one({"_id": oid})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Game not found")
     return {"message": "Game deleted successfully"}